@@ -5,70 +5,163 @@ Momentum Trading Algorithm
 Author: Seph Ghafarzadeh
 """
 
+import math
+import os
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
+import matplotlib.dates as mdates
+from matplotlib.collections import LineCollection
 import statsmodels.api as sm
 import statsmodels.formula.api as smf
+from numba import njit, prange
 
 #
 # Part 1 - Data Preparation
 #
 
-stock_prices = pd.read_csv('stock-prices.csv', 
-                           parse_dates = True, 
-                           index_col = 'date').pivot(columns = 'ticker', 
-                                                     values = 'price').ffill()
-
-snp_prices = pd.read_csv('snp-prices.csv',
-                          parse_dates = True,
-                          index_col = 'date')
-
-risk_free = pd.read_csv('risk-free.csv',
-                        parse_dates = True,
-                        index_col = 'date')
+def load_or_cache(sources, parq, loader):
+    if os.path.exists(parq) and all(os.path.getmtime(parq) > os.path.getmtime(src)
+                                    for src in sources + [__file__]):
+        return pd.read_parquet(parq)
+    df = loader()
+    df.columns = df.columns.astype(str)
+    df.to_parquet(parq)
+    return df
+
+def pivot_prices(raw):
+    raw = raw.sort_values(['date', 'ticker'])
+    dates = raw['date'].unique()
+    tickers = raw['ticker'].unique()
+    if (len(raw) == len(dates) * len(tickers)
+            and not raw.duplicated(['date', 'ticker']).any()):
+        return pd.DataFrame(raw['price'].values.reshape(len(dates), len(tickers)),
+                            index = pd.DatetimeIndex(dates, name = 'date'),
+                            columns = pd.Index(tickers, name = 'ticker'))
+    return raw.set_index(['date', 'ticker'])['price'].unstack()
+
+def load_stock_prices():
+    prices = pivot_prices(pd.read_csv('stock-prices.csv', 
+                                      engine = 'pyarrow',
+                                      dtype = {'price': 'float32', 'ticker': 'category'},
+                                      parse_dates = ['date']))
+    return prices.ffill()
+
+stock_prices = load_or_cache(['stock-prices.csv'], 'stock-prices.parquet',
+                             load_stock_prices)
+
+snp_prices = load_or_cache(
+    ['snp-prices.csv'], 'snp-prices.parquet',
+    lambda: pd.read_csv('snp-prices.csv',
+                        engine = 'pyarrow',
+                        dtype = {'spindx': 'float32'},
+                        parse_dates = ['date']).set_index('date'))
+
+risk_free = load_or_cache(
+    ['risk-free.csv'], 'risk-free.parquet',
+    lambda: pd.read_csv('risk-free.csv',
+                        engine = 'pyarrow',
+                        dtype = {'rf': 'float32'},
+                        parse_dates = ['date']).set_index('date'))
 
 """
-Imported given csv files for stock prices, snp prices, and risk free rate. 
+Imported given csv files for stock prices, snp prices, and risk free rate
+with the pyarrow csv reader, which parses the files and dates natively. 
 Included DateTime index functionality and set index column as DateTime index. 
+Read all prices and rates as float32 and tickers as categories to halve the
+memory used by every table, so all returns calculated below stay float32. 
+Turned the long table of stock prices into one column per ticker with the
+function pivot_prices(): when every ticker has a price on every date, the rows
+sorted by date and ticker are simply reshaped into the table, otherwise the
+table is built with .unstack().
 Forward filled stock_prices to correct missing prices.
+The function load_or_cache() saves each loaded dataframe as a parquet file and
+reads that file back on later runs, as long as it is newer than its csv files
+and this script, so editing the code that built a dataframe also rebuilds it.
 """
 
-stock_rets = stock_prices.pct_change()
-snp_rets = snp_prices.pct_change()
+def pct_change_np(prices):
+    p = prices.to_numpy()
+    r = np.empty_like(p)
+    r[0] = np.nan
+    np.divide(p[1:], p[:-1], out = r[1:])
+    r[1:] -= 1
+    return pd.DataFrame(r, index = prices.index, columns = prices.columns)
+
+stock_rets = pct_change_np(stock_prices)
+snp_rets = pct_change_np(snp_prices)
 
 """
-Calculated returns of stock prices and snp prices with .pct_change() function, 
-storing the values into new dataframes, stock_rets and snp_rets
+Calculated returns of stock prices and snp prices with the function
+pct_change_np(), which divides each row of prices by the row before it directly
+in numpy, storing the values into new dataframes, stock_rets and snp_rets
 """
 
 market_premium = snp_rets['spindx'] - risk_free['rf']
-stock_premium = stock_rets.copy()
 
 """
 Calculated market premium as the snp return minus the risk free rate, storing
 the values in the dataframe, market_premium.
-Prepared a new dataframe, stock_premium to store the values for stock premiums.
 """
 
-for ticker in stock_rets:
-    stock_premium.loc[:,ticker] = stock_rets.loc[:,ticker] - risk_free['rf']
-    
+rf = risk_free['rf'].reindex(stock_rets.index)
+stock_premium = stock_rets.sub(rf, axis = 0)
+
 """
-Calculated stock premium for each stock by iterating through each column of 
-the dataframe, stock_rets, and subtracting the risk free rate from each value,
-storing the new values in the dataframe, stock_premium.
+Calculated stock premium for every stock at once by subtracting the risk free
+rate from each row of the dataframe, stock_rets, storing the new values in the
+dataframe, stock_premium. The risk free rate is first reindexed to the dates of
+stock_rets so the subtraction does not add any extra dates.
 """
     
+@njit(parallel = True, cache = True)
+def rolling_prod_m1(logs, window, out):
+    T, N = logs.shape
+    for j in prange(N):
+        s = 0.0
+        non_finite = 0
+        for i in range(T):
+            if not np.isfinite(logs[i, j]):
+                non_finite += 1
+            else:
+                s += logs[i, j]
+            if i >= window:
+                if not np.isfinite(logs[i - window, j]):
+                    non_finite -= 1
+                else:
+                    s -= logs[i - window, j]
+            if i < window - 1 or non_finite > 0:
+                out[i, j] = np.nan
+            else:
+                out[i, j] = math.expm1(s)
+
+log_rets = np.asfortranarray(np.log1p(stock_premium.values))
+
+def formation_returns(window):
+    sums = np.empty_like(log_rets)
+    rolling_prod_m1(log_rets, window, sums)
+    return pd.DataFrame(sums,
+                        index = stock_premium.index,
+                        columns = stock_premium.columns)
+
 form = {}
 for window in [5, 30, 60, 90, 120]:
-     form[window] = stock_premium.rolling(window).apply(
-         lambda r: (1+r).prod() - 1, raw = True)
- 
+    form[window] = load_or_cache(['stock-prices.csv', 'risk-free.csv'],
+                                 f'form-{window}.parquet',
+                                 lambda: formation_returns(window))
+
 """
+Converted stock premiums to log returns, so the compounded return over a window
+is expm1 of the sum of the log returns inside it. The numba function
+rolling_prod_m1() keeps that sum as a running total for each stock in parallel,
+adding the newest log return and subtracting the one leaving the window. Its
+compiled code is cached on disk so later runs do not compile it again.
 Iterated through window sizes, using the window size in the current
 iteration as the rolling window to calculate formation period returns, storing
-the values in a dictionary of dataframes, form.
+the values in a dictionary of dataframes, form. A window containing a missing
+or infinite log return is left missing, and that return is never added to the
+running total, so the stock recovers once it leaves the window. Each formation
+period dataframe is cached as a parquet file with load_or_cache().
 Call different formation period dataframes with form[window]
 """
 
@@ -89,162 +182,119 @@ Call different hpr dataframes with hpr[window].
 # Part 2 - Algorithm Execution 
 #
 
-f5_ranks = form[5].rank(axis=1, ascending = False)
-f5_max = form[5].rank(axis=1, ascending = False).max(axis=1)
-f30_ranks = form[30].rank(axis=1, ascending = False)
-f30_max = form[30].rank(axis=1, ascending = False).max(axis=1)
-f90_ranks = form[90].rank(axis=1, ascending = False)
-f90_max = form[90].rank(axis=1, ascending = False).max(axis=1)
+def topk_mask(a, k):
+    idx = np.argpartition(-np.where(np.isnan(a), -np.inf, a), k, axis = -1)[..., :k]
+    mask = np.zeros(a.shape, dtype = bool)
+    np.put_along_axis(mask, idx, True, axis = -1)
+    return mask & ~np.isnan(a)
+
+def bottomk_mask(a, k):
+    idx = np.argpartition(np.where(np.isnan(a), np.inf, a), k, axis = -1)[..., :k]
+    mask = np.zeros(a.shape, dtype = bool)
+    np.put_along_axis(mask, idx, True, axis = -1)
+    return mask & ~np.isnan(a)
+
+f_windows = [5, 30, 90]
+h_windows = [5, 60, 120]
+
+form_arr = np.stack([form[window].values for window in f_windows])
+hpr_arr = np.nan_to_num(np.stack([hpr[window].values for window in h_windows]))
+
+top = topk_mask(form_arr, 5)
+bot = bottomk_mask(form_arr, 5)
 
 """
-Ranked all values by row in formation period dataframes in descending
-order with the function .rank() and stored these values. Also found the maximum
-rank within each row of each formation period dataframe, and stored this value
-to also be used for the algorithm below:
+Stacked the formation period dataframes into one 3-D array, form_arr, indexed by
+(formation period, date, stock), and the hpr dataframes into another, hpr_arr,
+indexed by (holding period, date, stock), with missing hpr values replaced by 0.
+Found the 5 highest and 5 lowest values by row for every formation period at once
+with the functions topk_mask() and bottomk_mask(). np.argpartition only moves
+the 5 wanted values to the front of each row instead of fully sorting it, and
+the positions it returns are marked True in a boolean mask. Missing values are
+pushed to the wrong end of the partition so they are never picked. Stored these
+masks in the arrays, top and bot, to be used for the algorithm below:
     
 The following algorithm was used for the trading strategies below: 
-I first called the top 5 ranks within each formation period (all ranks <= 5) 
-and the lowest 5 ranks within each formation period (all ranks >= the minimum rank + 5) 
+I first called the top 5 ranks within each formation period (top mask) 
+and the lowest 5 ranks within each formation period (bot mask) 
 and then used these parameters to call the same location of values in the appropriate
 hpr dataframe. A positive weighted average of equal weights was calculated for
 the hpr values associated with the top 5 formation period ranks, and a negative
 weighted average of equal weights was calculated for the hpr values associated with
 the lowest 5 ranks. These weighted averages were then summated to find the daily
 return for the combination of a given formation period and hpr, and these values
-were stored in a dataframe named by its according strategy. 
-Additionally, these dataframes with daily return values was used to calculate 
-cumulative returns for each strategy and was stored in a separate dataframe with
-the appropriate label. 
-Ultimately, both the daily returns dataframe and the cumulative returns dataframe were
-combined into a single dataframe with the pd.concat function, and these dataframes
-were exported as csv files as instructed. 
+were stored in the array, R, with one column per strategy. 
+Additionally, these daily return values were used to calculate 
+cumulative returns for each strategy, and both were exported as csv files. 
 """
 
-f5hpr5 = hpr[5][
-    f5_ranks <= 5].apply(lambda r: (0.2 * r).sum(), axis = 1) + hpr[5][
-        f5_ranks >= f5_ranks.eq((f5_max - 5), axis = 0)].apply(lambda r: (-0.2 * r).sum(), axis = 1)
-f5hpr5_cumrets = (1 + f5hpr5).cumprod() - 1  
-portfolio_f5hpr5 = pd.concat([f5hpr5, f5hpr5_cumrets], axis = 1).rename(
-    columns = {0: "rets", 1: "cum rets"}).to_csv('portfolio-f5hpr5.csv')
+weights = 0.2 * (top.astype(hpr_arr.dtype) - bot.astype(hpr_arr.dtype))
+rets = np.einsum('ftn,htn->fht', weights, hpr_arr, optimize = True)
 
-""""
-Portfolio 1: 5 day formation period, 5 day holding period returns
-"""
-
-f5hpr60 = hpr[60][
-    f5_ranks <= 5].apply(lambda r: (0.2 * r).sum(), axis = 1) + hpr[60][
-        f5_ranks >= f5_ranks.eq((f5_max - 5), axis = 0)].apply(lambda r: (-0.2 * r).sum(), axis = 1)  
-f5hpr60_cumrets = (1 + f5hpr60).cumprod() - 1            
-portfolio_f5hpr60 = pd.concat([f5hpr60, f5hpr60_cumrets], axis = 1).rename(
-    columns = {0: "rets", 1: "cum rets"}).to_csv('portfolio-f5hpr60.csv')
+strategies = [f'f{f_window}hpr{h_window}'
+              for f_window in f_windows for h_window in h_windows]
+R = rets.reshape(len(strategies), -1).T
 
-""""
-Portfolio 2: 5 day formation period, 60 day holding period returns
-"""
-         
-f5hpr120 = hpr[120][
-    f5_ranks <= 5].apply(lambda r: (0.2 * r).sum(), axis = 1) + hpr[120][
-        f5_ranks >= f5_ranks.eq((f5_max - 5), axis = 0)].apply(lambda r: (-0.2 * r).sum(), axis = 1)
-f5hpr120_cumrets = (1 + f5hpr120).cumprod() - 1
-portfolio_f5hpr120 = pd.concat([f5hpr120, f5hpr120_cumrets], axis = 1).rename(
-    columns = {0: "rets", 1: "cum rets"}).to_csv('portfolio-f5hpr120.csv')
-
-""""
-Portfolio 3: 5 day formation period, 120 day holding period returns
 """
-        
-f30hpr5 = hpr[5][
-    f30_ranks <= 5].apply(lambda r: (0.2 * r).sum(), axis = 1) + hpr[5][
-        f30_ranks >= f30_ranks.eq((f30_max - 5), axis = 0)].apply(lambda r: (-0.2 * r).sum(), axis = 1)
-f30hpr5_cumrets = (1 + f30hpr5).cumprod() - 1
-portfolio_f30hpr5 = pd.concat([f30hpr5, f30hpr5_cumrets], axis = 1).rename(
-    columns = {0: "rets", 1: "cum rets"}).to_csv('portfolio-f30hpr5.csv')
-
-""""
-Portfolio 4: 30 day formation period, 5 day holding period returns
-"""
-        
-f30hpr60 = hpr[60][
-    f30_ranks <= 5].apply(lambda r: (0.2 * r).sum(), axis = 1) + hpr[60][
-        f30_ranks >= f30_ranks.eq((f30_max - 5), axis = 0)].apply(lambda r: (-0.2 * r).sum(), axis = 1)
-f30hpr60_cumrets = (1 + f30hpr60).cumprod() - 1
-portfolio_f30hpr60 = pd.concat([f30hpr60, f30hpr60_cumrets], axis = 1).rename(
-    columns = {0: "rets", 1: "cum rets"}).to_csv('portfolio-f30hpr60.csv')
-
-""""
-Portfolio 5: 30 day formation period, 60 day holding period returns
-"""
-             
-f30hpr120 = hpr[120][
-    f30_ranks <= 5].apply(lambda r: (0.2 * r).sum(), axis = 1) + hpr[120][
-        f30_ranks >= f30_ranks.eq((f30_max - 5), axis = 0)].apply(lambda r: (-0.2 * r).sum(), axis = 1)
-f30hpr120_cumrets = (1 + f30hpr120).cumprod() - 1
-portfolio_f30hpr120 = pd.concat([f30hpr120, f30hpr120_cumrets], axis = 1).rename(
-    columns = {0: "rets", 1: "cum rets"}).to_csv('portfolio-f30hpr120.csv')
-
-""""
-Portfolio 6: 30 day formation period, 120 day holding period returns
+Calculated the daily returns of every combination of formation period (5, 30, 90
+days) and holding period (5, 60, 120 days), giving the 9 portfolios, in one step
+with np.einsum. The top and bottom masks were first combined into one array of
+weights, +0.2 for the top 5 stocks and -0.2 for the lowest 5, which np.einsum
+multiplies into the hpr values and sums across the stocks of each row, for
+every pair of formation and holding period at once. The result was reshaped
+into the array, R, with one column of daily returns per strategy.
 """
-        
-f90hpr5 = hpr[5][
-    f90_ranks <= 5].apply(lambda r: (0.2 * r).sum(), axis = 1) + hpr[5][
-        f90_ranks >= f90_ranks.eq((f90_max - 5), axis = 0)].apply(lambda r: (-0.2 * r).sum(), axis = 1)
-f90hpr5_cumrets = (1 + f90hpr5).cumprod() - 1
-portfolio_f90hpr5 = pd.concat([f90hpr5, f90hpr5_cumrets], axis = 1).rename(
-    columns = {0: "rets", 1: "cum rets"}).to_csv('portfolio-f90hpr5.csv')
-
-""""
-Portfolio 7: 90 day formation period, 5 day holding period returns
-"""
-        
-f90hpr60 = hpr[60][
-    f90_ranks <= 5].apply(lambda r: (0.2 * r).sum(), axis = 1) + hpr[60][
-        f90_ranks >= f90_ranks.eq((f90_max - 5), axis = 0)].apply(lambda r: (-0.2 * r).sum(), axis = 1)   
-f90hpr60_cumrets = (1 + f90hpr60).cumprod() - 1
-portfolio_f90hpr60 = pd.concat([f90hpr60, f90hpr60_cumrets], axis = 1).rename(
-    columns = {0: "rets", 1: "cum rets"}).to_csv('portfolio-f90hpr60.csv')
-
-""""
-Portfolio 8: 90 day formation period, 60 day holding period returns
+
+port_rets = pd.DataFrame(R, index = stock_premium.index, columns = strategies)
+port_cumrets = pd.DataFrame(np.cumprod(1 + R.astype(np.float64), axis = 0) - 1,
+                            index = stock_premium.index, columns = strategies)
+
+def export_portfolio(strategy):
+    pd.DataFrame({"rets": port_rets[strategy].values,
+                  "cum rets": port_cumrets[strategy].values},
+                 index = stock_premium.index).to_csv(f'portfolio-{strategy}.csv',
+                                                     float_format = '%.8g')
+
+for strategy in strategies:
+    export_portfolio(strategy)
+
 """
-        
-f90hpr120 = hpr[120][
-    f90_ranks <= 5].apply(lambda r: (0.2 * r).sum(), axis = 1) + hpr[120][
-        f90_ranks >= f90_ranks.eq((f90_max - 5), axis = 0)].apply(lambda r: (-0.2 * r).sum(), axis = 1)
-f90hpr120_cumrets = (1 + f90hpr120).cumprod() - 1
-portfolio_f90hpr120 = pd.concat([f90hpr120, f90hpr120_cumrets], axis = 1).rename(
-    columns = {0: "rets", 1: "cum rets"}).to_csv('portfolio-f90hpr120.csv')  
-
-""""
-Portfolio 9: 90 day formation period, 120 day holding period returns
+Calculated cumulative returns for every portfolio at once by compounding the
+daily returns down the columns of R with np.cumprod. The running product is
+done in float64 so rounding does not build up over thousands of days.
+Both the daily returns and the cumulative returns were
+placed into a single dataframe for each strategy,
+and these dataframes were exported as csv files as instructed, with values
+rounded to 8 significant digits.
 """
  
 #
 # Part 3 - Analysis
 #
 
-avg_rets = []
-min_rets = []
-max_rets = []
-
-for portfolio in [f5hpr5, f5hpr60, f5hpr120,
-                  f30hpr5, f30hpr60, f30hpr120,
-                  f90hpr5, f90hpr60, f90hpr120,]:
-    avg_rets.append(np.average(portfolio))
-    min_rets.append(np.min(portfolio))
-    max_rets.append(np.max(portfolio))
-    plt.plot(portfolio)
-    
+avg_rets = np.nanmean(R, axis = 0)
+min_rets = np.nanmin(R, axis = 0)
+max_rets = np.nanmax(R, axis = 0)
+
+ax = plt.gca()
+dates = mdates.date2num(stock_premium.index)
+ax.add_collection(LineCollection(
+    [np.column_stack([dates, R[:, i]]) for i in range(R.shape[1])],
+    colors = plt.rcParams['axes.prop_cycle'].by_key()['color']))
+ax.xaxis_date()
+ax.autoscale()
+
 plt.xlabel('Date')
 plt.ylabel('Returns (%)')
 plt.ylim(-3.5, 1.8)
 plt.title(label='Daily Returns of Portfolios')
 
 """
-Iterated through the dataframes for each strategy, calculating the average
-daily return, minimum daily return, maximum daily return, and plotting
-the values of each dataframe (the daily returns for each strategy) with 
-the date as the X axis and the returns as the Y axis. 
+Calculated the average daily return, minimum daily return, and maximum daily
+return of every strategy at once by reducing down the columns of the array, R,
+and plotted all columns of R (the daily returns for each strategy) with 
+the date as the X axis and the returns as the Y axis as a single LineCollection,
+which draws all 9 lines as one artist. 
 """
         
 d = {'port avg rets' : avg_rets,